@@ -1,26 +1,67 @@
 import random as rnd
+import itertools
+import os
+import multiprocessing
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import networkx as nx
 from graphviz import Digraph
 import numpy as np
-
-
-def measure_node_distance(firm_pos,path_pos):
-    """Support function to measure distance between product and firm
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def radius_hits(pos, prod, r2, out_mask):
+        for i in prange(pos.shape[0]):
+            d2 = 0.0
+            for d in range(pos.shape[1]):
+                diff = pos[i,d] - prod[d]
+                d2 += diff*diff
+            out_mask[i] = d2 <= r2
+else:
+    def radius_hits(pos, prod, r2, out_mask):
+        np.less_equal(((pos - prod)**2).sum(axis=1), r2, out=out_mask)
+
+def query_radius(firm_pos, prod_pos, radius):
+    """Support function to find the firms within the radius of each product
+
+    Uses a SciPy kd-tree when available, otherwise checks squared distances
+    to every firm (Numba-compiled if Numba is installed). In both cases a firm
+    counts as in range if its distance is at most the radius
 
     Args:
-        node_pos (list): multi-dimensional position of the firm
-        path_pos (list): multi-dimensional position of the product
+        firm_pos (np.ndarray): positions of the firms, shape (firms, dimensions)
+        prod_pos (np.ndarray): positions of the products, shape (products, dimensions)
+        radius (float): radius within which connection occurs
 
     Returns:
-        float: Euclidean distance between firm and product
+        list: sorted indices into firm_pos of the firms with distance <= radius, one entry per product
     """
-    return np.sqrt(np.sum([(firm_pos[i] - path_pos[i])**2 for i in range(len(firm_pos))]))
-
-def create_graph(graph_num,firms_per_label, number_products, connect_vector, radius, seed):
-    """Creates a single SCN graph
+    if radius < 0: ### squaring below would drop the sign, but no distance is below a negative radius
+        return [[] for _ in range(prod_pos.shape[0])]
+    if cKDTree is not None:
+        return cKDTree(firm_pos).query_ball_point(prod_pos, r=radius, return_sorted=True)
+    r2 = radius * radius
+    out_mask = np.empty(firm_pos.shape[0], dtype=np.bool_)
+    hits = []
+    for p in range(prod_pos.shape[0]):
+        radius_hits(firm_pos, prod_pos[p], r2, out_mask)
+        hits.append(np.flatnonzero(out_mask))
+    return hits
+
+def build_graph(firms_per_label, number_products, connect_vector, radius, seed):
+    """Builds a single SCN graph
 
     Args:
-        graph_num (int): identifying number of the graph to generate
         firms_per_label (list): number of firms (int) associated with each label
         number_products (int): number of products that should be generated
         connect_vector (list): number of firms at each label that can at most be used in the production of one product
@@ -28,84 +69,115 @@ def create_graph(graph_num,firms_per_label, number_products, connect_vector, rad
         seed (int): random seed
 
     Returns:
-        dictionary: NetworkX-generated graph dictionary
-        string: pdf file name
+        nx.DiGraph: the SCN graph
+        np.ndarray: position of each node of the SCN graph
     """
-    rnd.seed(seed)
+    rng = np.random.default_rng(seed)
     labels = len(firms_per_label)
+    total_firms = sum(firms_per_label)
+    scale = float(np.sqrt(total_firms))
 
-    # Create auxiliary graph with nodes
-    G = nx.DiGraph()
-    label_nodes = {}
-    position = {}
-    node = 0
-    for label in range(labels):
-        sup = []
-        for i in range(firms_per_label[label]):
-            G.add_node(node)
-            G.nodes[node]["label"] = label
-            sup.append(node)
-            position[node] = [rnd.random()*np.sqrt(np.sum(firms_per_label)) for _ in range(2)]
-            node += 1
-        label_nodes[label] = sup
+    # Place all firms and products at once, and assign firms to labels consecutively
+    all_pos = rng.random((total_firms + number_products, 2)) * scale
+    pos_arr = all_pos[:total_firms]
+    prod_pos = all_pos[total_firms:]
+    label_of_node = np.repeat(np.arange(labels, dtype=np.int32), firms_per_label)
+    label_idx = {label:np.flatnonzero(label_of_node == label) for label in range(labels)}
 
+    # Find the firms of each label within the radius of every product in one query
+    hits = [query_radius(pos_arr[label_idx[label]], prod_pos, radius) for label in range(labels)]
 
     # Create products and connect to nodes based on Euclidean distances
-    # Throw out products with only one node
+    # Throw out products with only one node, and products using the same firms as an earlier one
     product_list = []
-    for _ in range(number_products):
-        new_product = []
-        product_pos = [rnd.random()*np.sqrt(np.sum(firms_per_label)) for _ in range(2)]
+    seen = set()
+    used = set()
+    for p in range(number_products):
+        product = {label:[] for label in range(labels)}
         for label in range(labels):
-            node_distances = {n:measure_node_distance(position[n],product_pos) for n in label_nodes[label]}
-            nodes_in_range = [key for (key,value) in node_distances.items() if value < radius]
-            if len(nodes_in_range) > 0:
-                chosen_nodes = rnd.sample(nodes_in_range,min(len(nodes_in_range),connect_vector[label]))
-                new_product += chosen_nodes
-        if (not new_product in product_list) and len(new_product) > 1:
-            product_list.append(new_product)
-            G.add_node(node)
-            for chosen_node in new_product:
-                G.add_edge(chosen_node,node)
-            node += 1
-
-    # Delete any node that does not contribute to a product
-    for n in range(node):
-        if len(list(G.successors(n))) == 0 and len(list(G.predecessors(n))) == 0:
-            G.remove_node(n)
-
-    # Relabel nodes to start from zero and go consecutively (i.e. if i->j, then i<j)
-    mapping = {}
-    new_node = 0
-    for node in G.nodes:
-        mapping[node] = new_node
-        new_node += 1
-    G = nx.relabel_nodes(G, mapping)
-
-    # Create product-list from auxiliary graph
-    product_list = []
-    node_set = set()
-    for node in G.nodes:
-        if len(list(G.predecessors(node))) > 0:
-            product = {label:[] for label in range(labels)}
-            firms_to_add = G.predecessors(node)
-            for firm in firms_to_add:
-                product[G.nodes[firm]["label"]].append(firm)
+            nodes_in_range = label_idx[label][hits[label][p]]
+            if nodes_in_range.size > connect_vector[label]:
+                chosen_nodes = nodes_in_range[rng.permutation(nodes_in_range.size)[:connect_vector[label]]]
+                product[label] = np.sort(chosen_nodes).tolist()
+            elif nodes_in_range.size > 0: ### all firms in range are used, already sorted
+                product[label] = nodes_in_range.tolist()
+        new_product = [firm for label in range(labels) for firm in product[label]]
+        key = tuple(sorted(new_product))
+        if len(new_product) > 1 and key not in seen:
+            seen.add(key)
             product_list.append(product)
-            node_set.update(list(G.predecessors(node)))
+            used.update(new_product)
+
+    # Relabel used firms to start from zero and go consecutively (i.e. if i->j, then i<j)
+    # Firms that do not contribute to a product are dropped
+    used_firms = np.array(sorted(used), dtype=np.int64)
+    n = used_firms.size
+
+    # Collect the edges of all products as index arrays, then add the distinct ones to the graph at once
+    rows, cols = [], []
+    for product in product_list:
+        active_groups = [product[label] for label in range(labels) if len(product[label]) > 0]
+        for i in range(len(active_groups)-1):
+            for firm1, firm2 in itertools.product(active_groups[i], active_groups[i+1]):
+                rows.append(firm1)
+                cols.append(firm2)
+    rows = np.searchsorted(used_firms, np.array(rows, dtype=np.int64))
+    cols = np.searchsorted(used_firms, np.array(cols, dtype=np.int64))
+    edges = np.unique(rows * n + cols)
 
     # Create original graph based on product-list
     OG = nx.DiGraph()
-    OG.add_nodes_from(node_set)
-    for product in product_list:
-        active_labels = [key for key in product.keys() if len(product[key]) > 0]
-        for i in range(len(active_labels)-1):
-            for firm1 in product[active_labels[i]]:
-                for firm2 in product[active_labels[i+1]]:
-                    OG.add_edge(firm1,firm2)
-    graph_dict = nx.node_link_data(OG)
-
-    # Print SCN
+    OG.add_nodes_from(range(n))
+    OG.add_edges_from(zip((edges // n).tolist(), (edges % n).tolist()))
+    node_pos = pos_arr[used_firms]
+
+    return OG, node_pos
+
+def render_svg(OG, node_pos, path):
+    """Writes an SCN graph directly to an svg file, drawing each firm at its position
+
+    Args:
+        OG (nx.DiGraph): the SCN graph
+        node_pos (np.ndarray): position of each node of the SCN graph
+        path (str): svg file name
+
+    Returns:
+        string: svg file name
+    """
+    scale, margin, r = 60, 20, 10
+    xy = node_pos * scale + margin
+    width, height = xy.max(axis=0) + margin if len(xy) > 0 else (2*margin, 2*margin)
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%.0f" height="%.0f">' % (width, height),
+             '<title>SCN</title>',
+             '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="6" markerHeight="6" orient="auto">'
+             '<path d="M0,0 L10,5 L0,10 z"/></marker></defs>']
+    # Stop each edge at the border of its target circle so the arrow head stays visible
+    for u, v in OG.edges:
+        d = xy[v] - xy[u]
+        end = xy[v] - d * r / max(np.hypot(d[0], d[1]), r)
+        parts.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="black" marker-end="url(#arrow)"/>'
+                     % (xy[u][0], xy[u][1], end[0], end[1]))
+    for node in OG.nodes:
+        parts.append('<circle cx="%.1f" cy="%.1f" r="%d" stroke="black" fill="lightblue"/>' % (xy[node][0], xy[node][1], r))
+        parts.append('<text x="%.1f" y="%.1f" font-size="10" text-anchor="middle" dominant-baseline="central">%d</text>'
+                     % (xy[node][0], xy[node][1], node))
+    parts.append('</svg>')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as svg_file:
+        svg_file.write('\n'.join(parts))
+    return path
+
+def render_graph(OG, graph_num, folder='/static'):
+    """Renders an SCN graph to pdf with Graphviz
+
+    Args:
+        OG (nx.DiGraph): the SCN graph
+        graph_num (int): identifying number of the graph, used in the file name
+        folder (str): folder to write the pdf to
+
+    Returns:
+        string: pdf file name
+    """
     dot = Digraph(name='graph_'+str(graph_num),format='pdf')
     dot.attr(rankdir='TB',size='8',label="SCN",labelloc="top")
     dot.attr('node', shape='circle')
@@ -116,14 +188,30 @@ def create_graph(graph_num,firms_per_label, number_products, connect_vector, rad
     for edge in OG.edges:
         dot.edge(str(edge[0]),str(edge[1]))
     dot.attr(fontsize='14')
-    pdf = dot.render(filename = '/static/graph_' + str(graph_num),view=False,format='pdf')
+    pdf = dot.render(filename = os.path.join(folder, 'graph_' + str(graph_num)),view=False,format='pdf')
+
+    return pdf
 
-    return graph_dict, pdf
+def build_graph_star(args):
+    """Unpacks a tuple of build_graph arguments, so graphs can be built with Executor.map"""
+    return build_graph(*args)
 
+# Worker processes for building graphs, started on first use and shared by all calls
+# Workers are spawned rather than forked, so they do not inherit the threads of the server or of Numba
+builders = None
+builders_lock = threading.Lock()
 
+def get_builders():
+    """Returns the shared process pool used to build graphs, creating it if needed"""
+    global builders
+    with builders_lock:
+        if builders is None:
+            builders = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+    return builders
 
 
-def create_multiple_graphs(number_graphs,number_firms,number_products,number_labels,radius,connect_vector,seed):
+
+def create_multiple_graphs(number_graphs,number_firms,number_products,number_labels,radius,connect_vector,seed,pdf=False,folder='/static'):
     """Creates multiple SCN graphs
 
     Args:
@@ -133,40 +221,51 @@ def create_multiple_graphs(number_graphs,number_firms,number_products,number_lab
         number_labels (int): number of labels to which firms are assigned
         radius (float): radius within which connection occurs
         seed (int): random seed
+        pdf (bool): whether to also render each graph to pdf with Graphviz
+        folder (str): folder to write the graph files to
 
     Returns:
         dictionary: dictionary of all graphs, containing a NetworkX-generated dictionary for each, plus generation information
-        list: list of pdf file names
+        list: list of svg file names, followed by the pdf file names if requested
     """
     # Compute remaining parameters
     firms_per_label = [round(number_firms/number_labels)]*number_labels
     if connect_vector is None:
         connect_vector = [1]*number_labels
-    rnd.seed(seed)
-    seeds = [rnd.randint(1,100000) for _ in range(number_graphs)]
+    seed_rnd = rnd.Random(seed)
+    seeds = [seed_rnd.randint(1,100000) for _ in range(number_graphs)]
 
     # Create graphs
-    pdfs = []
+    svgs = []
+    pdfs = [None]*number_graphs if pdf else []
     full_dict = {   "firms_per_label": firms_per_label,
                     "number_products": number_products,
                     "radius": radius,
                     "seed": seed,
                     "graphs": []}
-    for i in range(number_graphs):
-        graph_dict, pdf = create_graph(i,firms_per_label, number_products, connect_vector, radius, seeds[i])
-        full_dict['graphs'].append(graph_dict)
-        pdfs.append(pdf)
+    # Graphs are independent, so they are built in parallel worker processes
+    # Svgs are written right away; pdfs, if requested, are rendered in threads while the remaining graphs are still being built
+    args = [(firms_per_label, number_products, connect_vector, radius, seeds[i]) for i in range(number_graphs)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) if pdf else contextlib.nullcontext() as renderers:
+        renders = {}
+        for i, (OG, node_pos) in enumerate(get_builders().map(build_graph_star, args)):
+            full_dict['graphs'].append(nx.node_link_data(OG))
+            svgs.append(render_svg(OG, node_pos, os.path.join(folder, 'graph_' + str(i) + '.svg')))
+            if pdf:
+                renders[renderers.submit(render_graph, OG, i, folder)] = i
+        for future in as_completed(renders):
+            pdfs[renders[future]] = future.result()
     
-    return full_dict, pdfs
+    return full_dict, svgs + pdfs
 
 def display_results(number_graphs=2,number_firms=10,number_products=50,number_labels=4,radius=1,connect_vector=None,seed=9453):
     # TODO: Add parameter checks
 
-    graph_dict, pdfs = create_multiple_graphs(number_graphs,number_firms,number_products,number_labels,radius,connect_vector,seed)
+    graph_dict, graph_files = create_multiple_graphs(number_graphs,number_firms,number_products,number_labels,radius,connect_vector,seed)
 
-    # TODO: display first pdf on page
+    # TODO: display first graph on page
 
-    # TODO: zip pdfs and create download button
+    # TODO: zip graphs and create download button
 
     # TODO: create download button for graph_dict (as json)
 
@@ -175,15 +274,65 @@ from flask import Flask, render_template,redirect
 from flask import request,send_file
 import zipfile
 import json
-import os
+try:
+    import orjson
+except ImportError:
+    orjson = None
+import hashlib
 import shutil
+import tempfile
+import time
 import atexit
 import traceback
 
-def zip_files(files, zip_path):
+def zip_files(files, zip_path, extra_members=None):
     with zipfile.ZipFile(zip_path, 'w') as zipf:
+        ### files are stored under static/, wherever they were written
         for file_path in files:
-            zipf.write(file_path)
+            zipf.write(file_path, os.path.join('static', os.path.basename(file_path)))
+        ### members written straight from memory, given as {name: bytes}
+        for name, payload in (extra_members or {}).items():
+            zipf.writestr(name, payload)
+
+### Results of previous submissions, keyed by a hash of their inputs and of the generator version
+cache_folder = '/static/cache'
+cache_version = 2 ### bump whenever a change alters the graphs generated for the same inputs
+cache_max_entries = 100
+cache_max_age = 24*60*60 ### seconds
+
+def cache_key(params):
+    return hashlib.sha256(json.dumps(dict(params, cache_version=cache_version), sort_keys=True).encode()).hexdigest()
+
+def publish(sources, targets):
+    ### copy to a temporary name and rename into place, so a concurrent reader never sees a partial file
+    for source, target in zip(sources, targets):
+        tmp_path = target + '.tmp' + str(os.getpid()) + '_' + str(threading.get_ident())
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+def prune_cache():
+    ### drop entries older than cache_max_age, then the oldest ones beyond cache_max_entries
+    entries = {}
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        try:
+            if not os.path.isfile(path): ### folders of requests still in progress
+                continue
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        key = name.split('.')[0]
+        age, paths = entries.get(key, (0, []))
+        entries[key] = (max(age, mtime), paths + [path])
+    newest_first = sorted(entries.values(), key=lambda entry: entry[0], reverse=True)
+    now = time.time()
+    for rank, (mtime, paths) in enumerate(newest_first):
+        if rank >= cache_max_entries or now - mtime > cache_max_age:
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
 
 
 
@@ -211,6 +360,7 @@ def get_values():
         number_products = int(request.form['number_products'])
         number_labels = int(request.form['number_labels'])
         seed = int(request.form['seed'])
+        pdf = 'pdf' in request.form ### also render pdfs with Graphviz (slower)
         connect_vector = []
         for i in range(number_labels):
             input_value = int(request.form["number_labels" + str(i)])
@@ -226,7 +376,7 @@ def get_values():
         else:
             radius = float(radius)
 
-        if radius == 0:
+        if radius <= 0:
             err_mes = err_mes + "Radius must be Positive" + "\n"
 
         if number_labels > number_firms:
@@ -237,19 +387,43 @@ def get_values():
                 err_mes = err_mes + "Maximum Number of Firms with Label" + str(idx) + " can not be larger than Number of Firms" + "\n"
 
         try:
-            #### Construct the Graphs and PDFs
-            graph_dict, pdfs = create_multiple_graphs(number_graphs, number_firms,
-                                                      number_products, number_labels, radius, connect_vector,seed)
-            ### Convert the dictionary to a json file
-            with open('/static/graph_dict.json', 'w') as json_file:
-                json.dump(graph_dict, json_file)
-            ### zip all data
-            files = pdfs + ['/static/graph_dict.json']
-            zip_path = '/static/data.zip'
-            zip_files(files, zip_path)
+            #### Reuse the results of an identical earlier submission, if there is one
+            params = {"number_graphs": number_graphs, "number_firms": number_firms,
+                      "number_products": number_products, "number_labels": number_labels,
+                      "radius": radius, "seed": seed, "connect_vector": connect_vector, "pdf": pdf}
+            key = cache_key(params)
+            served = ['/static/graph_0.svg', '/static/data.zip']
+            cached = [os.path.join(cache_folder, key + os.path.splitext(path)[1]) for path in served]
+            hit = all(os.path.isfile(path) for path in cached)
+            if hit:
+                try:
+                    publish(cached, served)
+                except OSError: ### evicted in the meantime
+                    hit = False
+            if not hit:
+                #### Construct the Graphs and SVGs in a folder of this request only, so concurrent requests never mix up files
+                os.makedirs(cache_folder, exist_ok=True)
+                work_folder = tempfile.mkdtemp(dir=cache_folder)
+                try:
+                    graph_dict, graph_files = create_multiple_graphs(number_graphs, number_firms,
+                                                              number_products, number_labels, radius, connect_vector,seed,pdf,work_folder)
+                    ### zip all data, with the dictionary as a json file
+                    if orjson is not None:
+                        payload = orjson.dumps(graph_dict, option=orjson.OPT_SERIALIZE_NUMPY)
+                    else:
+                        payload = json.dumps(graph_dict).encode()
+                    zip_path = os.path.join(work_folder, 'data.zip')
+                    zip_files(graph_files, zip_path, {'static/graph_dict.json': payload})
+                    results = [graph_files[0], zip_path]
+                    publish(results, served)
+                    ### store the results for identical submissions; the zip comes last, so an entry only looks complete once fully written
+                    publish(results, cached)
+                    prune_cache()
+                finally:
+                    shutil.rmtree(work_folder, ignore_errors=True)
 
             ## Show the first Graph
-            pdf_url = '/static/graph_0.pdf'
+            graph_url = '/static/graph_0.svg'
             massage = "Supply chains have been created for the following specification: "\
                       + '\n' + " Number of Graphs: " + str(number_graphs) +\
                       '\n' + 'Number of Firms: ' + str(number_firms)\
@@ -262,7 +436,7 @@ def get_values():
             err_mes = err_mes.split('\n')
 
             if err_mes==['']:
-                return render_template('index.html', massage=massage, pdf_url=pdf_url)
+                return render_template('index.html', massage=massage, graph_url=graph_url)
             else:
                 return render_template('index.html', err_mes=err_mes)
 
@@ -297,7 +471,9 @@ def delete_static_folder():
             print(e)
 
 ### delete previous things on Static Folder after all!
-atexit.register(delete_static_folder)
+### Only in the main process: worker processes that re-import this module (spawn start method) must not clean up
+if multiprocessing.parent_process() is None:
+    atexit.register(delete_static_folder)
 
 
 app.secret_key = 'some key that you will never guess'